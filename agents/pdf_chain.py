@@ -1,42 +1,51 @@
 from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_classic.chains import create_retrieval_chain
 from langchain_classic.chains.combine_documents import create_stuff_documents_chain
-from models.embeddings_faiss import create_faiss_index, get_retriever
+from models.embeddings_faiss import get_retriever
 from config.settings import OPENAI_API_KEY
+from config.http_client import ASYNC_CLIENT, SYNC_CLIENT
 
-def create_pdf_chain(text: str):
-    if not OPENAI_API_KEY:
-        raise ValueError("OPENAI_API_KEY not found.")
+#the LLM, prompt, and stuff-documents chain only depend on static config,
+#so build them once at import instead of per /query
+_LLM = ChatOpenAI(
+    model="gpt-4.1-mini",
+    temperature=0.1,
+    api_key=OPENAI_API_KEY,
+    streaming=True,
+    http_client=SYNC_CLIENT,
+    http_async_client=ASYNC_CLIENT
+)
+
+_SYSTEM_PROMPT = (
+    "You are an intelligent PDF assistant. Your main goal is to help the user "
+    "by answering questions using the provided PDF content as your primary source of truth.\n\n"
+    "However, if the user's question is relevant to the topic of the PDF but not directly answered "
+    "within the provided context, you may use your general knowledge to give a helpful and reasonable answer.\n\n"
+    "If the question is completely unrelated to the PDF or outside its scope, reply with: "
+    "'This seems unrelated to the PDF.'\n\n"
+    "Be concise, factual, and conversational.\n\n"
+    "Context:\n{context}"
+)
 
-    vectorstore = create_faiss_index(text)
-    retriever = get_retriever(vectorstore)
+#history rides along as real chat messages so the model doesn't reparse a
+#flattened transcript and the retriever only ever sees the current question
+_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        ("system", _SYSTEM_PROMPT),
+        MessagesPlaceholder("chat_history", optional=True),
+        ("human", "{input}"),
+    ]
+)
 
-    llm = ChatOpenAI(
-        model="gpt-4.1-mini",
-        temperature=0.1,
-        api_key=OPENAI_API_KEY,
-        streaming=True
-    )
-    system_prompt = (
-        "You are an intelligent PDF assistant. Your main goal is to help the user "
-        "by answering questions using the provided PDF content as your primary source of truth.\n\n"
-        "However, if the user's question is relevant to the topic of the PDF but not directly answered "
-        "within the provided context, you may use your general knowledge to give a helpful and reasonable answer.\n\n"
-        "If the question is completely unrelated to the PDF or outside its scope, reply with: "
-        "'This seems unrelated to the PDF.'\n\n"
-        "Be concise, factual, and conversational.\n\n"
-        "Context:\n{context}"
-    )
+_QA_CHAIN = create_stuff_documents_chain(_LLM, _PROMPT)
 
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", system_prompt),
-            ("human", "{input}"),
-        ]
-    )
+def create_pdf_chain(vectorstore):
+    """Build the RAG chain on top of an already-built FAISS vectorstore.
+
+    Only the retriever is per-vectorstore; everything else is shared.
+    """
+    if not OPENAI_API_KEY:
+        raise ValueError("OPENAI_API_KEY not found.")
 
-    question_answer_chain = create_stuff_documents_chain(llm, prompt)
-    rag_chain = create_retrieval_chain(retriever, question_answer_chain)
-    
-    return rag_chain
\ No newline at end of file
+    return create_retrieval_chain(get_retriever(vectorstore), _QA_CHAIN)
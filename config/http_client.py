@@ -0,0 +1,13 @@
+import httpx
+
+#one shared connection pool for all OpenAI traffic, so connections stay warm
+#across requests instead of paying a TLS handshake per client instance
+_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+
+ASYNC_CLIENT = httpx.AsyncClient(http2=True, limits=_LIMITS, timeout=60)
+SYNC_CLIENT = httpx.Client(http2=True, limits=_LIMITS, timeout=60)
+
+async def close_http_clients():
+    """Close the shared clients on app shutdown."""
+    await ASYNC_CLIENT.aclose()
+    SYNC_CLIENT.close()
@@ -1,19 +1,44 @@
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
+from langchain_core.messages import AIMessage, HumanMessage
+import asyncio
+import hashlib
+import sys
 import tempfile
 import os
+from collections import OrderedDict, defaultdict
+from uuid import uuid4
 from models.pdf_processor import extract_text_from_pdf
+from models.embeddings_faiss import acreate_faiss_index, load_persisted_index, persist_index
+from models import redis_cache
 from agents.pdf_chain import create_pdf_chain
+from config.http_client import close_http_clients
 import logging
 from typing import List
-import json
+import orjson
+import tiktoken
 
 #configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="PDF Agent API")
+#quiet chatty per-request logging from the OpenAI client
+logging.getLogger("openai").setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+class HealthCheckFilter(logging.Filter):
+    """Drop uvicorn access-log lines for /health polling."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return "/health" not in record.getMessage()
+
+
+logging.getLogger("uvicorn.access").addFilter(HealthCheckFilter())
+
+app = FastAPI(title="PDF Agent API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,7 +51,103 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-vectorstore_cache = {}
+MAX_CACHE_ENTRIES = int(os.getenv("MAX_CACHE_ENTRIES", "64"))
+MAX_CACHE_BYTES = int(os.getenv("MAX_CACHE_BYTES", str(512 * 1024 * 1024)))
+
+
+def estimate_entry_bytes(entry: dict) -> int:
+    """Rough resident size of a cache entry (FAISS vectors dominate)."""
+    nbytes = 0
+    vectorstore = entry.get("vectorstore")
+    if vectorstore is not None:
+        index = vectorstore.index
+        nbytes += index.ntotal * index.d * 4
+    text = entry.get("text")
+    if text is not None:
+        nbytes += sys.getsizeof(text)
+    return nbytes
+
+
+class VectorstoreCache:
+    """LRU cache over indexed PDFs, bounded by entry count and total bytes.
+
+    All access goes through an asyncio.Lock so concurrent /index_pdf and
+    /cache deletes can't race on the underlying dict.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = asyncio.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    async def get(self, file_id: str):
+        async with self._lock:
+            entry = self._entries.get(file_id)
+            if entry is not None:
+                self._entries.move_to_end(file_id)
+            return entry
+
+    async def put(self, file_id: str, entry: dict):
+        """Insert an entry, evicting LRU entries until under both caps."""
+        entry["nbytes"] = estimate_entry_bytes(entry)
+        evicted = []
+        async with self._lock:
+            if file_id in self._entries:
+                self._total_bytes -= self._entries.pop(file_id)["nbytes"]
+            self._entries[file_id] = entry
+            self._total_bytes += entry["nbytes"]
+            while len(self._entries) > self.max_entries or (
+                self._total_bytes > self.max_bytes and len(self._entries) > 1
+            ):
+                old_id, old_entry = self._entries.popitem(last=False)
+                self._total_bytes -= old_entry["nbytes"]
+                evicted.append(old_id)
+        for old_id in evicted:
+            logger.info("Evicted file_id %s from cache (LRU)", old_id)
+        return evicted
+
+    async def delete(self, file_id: str):
+        async with self._lock:
+            entry = self._entries.pop(file_id, None)
+            if entry is not None:
+                self._total_bytes -= entry["nbytes"]
+            return entry
+
+    async def clear(self):
+        async with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._total_bytes = 0
+            return count
+
+    async def snapshot(self):
+        async with self._lock:
+            return list(self._entries.items())
+
+
+vectorstore_cache = VectorstoreCache(MAX_CACHE_ENTRIES, MAX_CACHE_BYTES)
+
+#per-file_id locks so concurrent /index_pdf calls for the same PDF don't
+#both extract and embed; the loser of the race awaits and hits the cache
+_index_locks = defaultdict(asyncio.Lock)
+
+
+def _drop_index_locks(file_ids):
+    for file_id in file_ids:
+        _index_locks.pop(file_id, None)
+
+#one scratch directory per worker process; uploads get unique names inside it
+#instead of creating and destroying a NamedTemporaryFile per request
+TMP_DIR = tempfile.mkdtemp(prefix="pdfrag-")
 
 AGENT_API_KEY = os.getenv("AGENT_API_KEY")
 
@@ -34,6 +155,12 @@ if not AGENT_API_KEY:
     raise ValueError("AGENT_API_KEY not set in environment variables")
 
 
+@app.on_event("shutdown")
+async def shutdown():
+    await close_http_clients()
+    await redis_cache.close_redis()
+
+
 class Message(BaseModel):
     role: str 
     content: str
@@ -42,7 +169,7 @@ class Message(BaseModel):
 async def verify_api_key(x_api_key: str = Header(...)):
     """Verify that the request has a valid API key."""
     if x_api_key != AGENT_API_KEY:
-        logger.warning(f"Unauthorized access attempt with invalid API key")
+        logger.warning("Unauthorized access attempt with invalid API key")
         raise HTTPException(
             status_code=401,
             detail="Invalid API key"
@@ -50,17 +177,35 @@ async def verify_api_key(x_api_key: str = Header(...)):
     return True
 
 
-def format_history_for_context(messages: List[Message]) -> str:
-    """Convert message list to text context for the LLM."""
-    if not messages:
-        return ""
-    
-    lines = []
-    for msg in messages:
-        role = "User" if msg.role == "user" else "Assistant"
-        lines.append(f"{role}: {msg.content}")
-    
-    return "\n".join(lines)
+#cap on chat history tokens sent to the LLM per turn
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "2048"))
+
+try:
+    _ENCODING = tiktoken.encoding_for_model("gpt-4.1-mini")
+except KeyError:
+    _ENCODING = tiktoken.get_encoding("o200k_base")
+
+
+def truncate_history(messages: List[Message]) -> List[Message]:
+    """Keep the newest messages that fit within HISTORY_TOKEN_BUDGET tokens."""
+    kept = []
+    total = 0
+    for msg in reversed(messages):
+        total += len(_ENCODING.encode(msg.content))
+        if total > HISTORY_TOKEN_BUDGET:
+            break
+        kept.append(msg)
+    kept.reverse()
+    return kept
+
+
+def history_to_messages(messages: List[Message]):
+    """Convert the message list to langchain chat messages for the prompt."""
+    return [
+        HumanMessage(content=msg.content) if msg.role == "user"
+        else AIMessage(content=msg.content)
+        for msg in messages
+    ]
 
 
 @app.post("/index_pdf")
@@ -70,52 +215,116 @@ async def index_pdf(
     _: bool = Depends(verify_api_key)
 ):
     try:
-        content = await file.read()
-        if not content:
-            raise HTTPException(status_code=400, detail="Empty file")
-        
         #check if already indexed
-        if file_id in vectorstore_cache:
-            logger.info(f"File already indexed: {file_id}")
+        if await vectorstore_cache.get(file_id) is not None:
+            logger.info("File already indexed: %s", file_id)
             return {
                 "file_id": file_id,
                 "file_name": file.filename,
                 "already_indexed": True
             }
-        
-        #extract text and index
-        tmp_path = None
-        try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-                tmp.write(content)
-                tmp_path = tmp.name
-            
-            text = extract_text_from_pdf(tmp_path)
-            if not text:
-                raise HTTPException(status_code=400, detail="Could not extract text from PDF")
-
-            #cache by file_id
-            vectorstore_cache[file_id] = {
-                'text': text,
-                'file_name': file.filename,
-                'text_length': len(text)
-            }
-            
-            logger.info(f"Indexed {file.filename} (file_id: {file_id}) - {len(text)} chars")
-            
-            return {
-                "file_id": file_id,
-                "file_name": file.filename,
-                "text_length": len(text),
-                "already_indexed": False
-            }
-        
-        finally:
-            if tmp_path and os.path.exists(tmp_path):
-                os.unlink(tmp_path)
-    
+
+        async with _index_locks[file_id]:
+            #re-check: another request may have built this file_id while we waited
+            if await vectorstore_cache.get(file_id) is not None:
+                logger.info("File already indexed: %s", file_id)
+                return {
+                    "file_id": file_id,
+                    "file_name": file.filename,
+                    "already_indexed": True
+                }
+
+            #another worker may have already built this file_id in Redis
+            loaded = await redis_cache.load_index(file_id)
+            if loaded is not None:
+                vectorstore, meta = loaded
+                evicted = await vectorstore_cache.put(file_id, {
+                    'vectorstore': vectorstore,
+                    'chain': create_pdf_chain(vectorstore),
+                    'file_name': meta.get('file_name', file.filename),
+                    'digest': meta.get('digest'),
+                    'text_length': meta.get('text_length')
+                })
+                _drop_index_locks(evicted)
+                logger.info("Loaded index for file_id %s from Redis", file_id)
+                return {
+                    "file_id": file_id,
+                    "file_name": file.filename,
+                    "already_indexed": True
+                }
+
+            #extract text and index
+            tmp_path = None
+            try:
+                #stream the upload to disk in 1MB chunks instead of buffering it all in RAM,
+                #hashing as we go so identical PDFs de-dup across file_ids and restarts
+                hasher = hashlib.sha256()
+                tmp_path = os.path.join(TMP_DIR, f"{uuid4().hex}.pdf")
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                try:
+                    while chunk := await file.read(1 << 20):
+                        hasher.update(chunk)
+                        os.write(fd, chunk)
+                finally:
+                    os.close(fd)
+
+                if os.path.getsize(tmp_path) == 0:
+                    raise HTTPException(status_code=400, detail="Empty file")
+
+                digest = hasher.hexdigest()
+
+                #reuse a persisted index for this exact PDF if one exists
+                vectorstore = await asyncio.to_thread(load_persisted_index, digest)
+                if vectorstore is not None:
+                    logger.info("Loaded persisted index %s for file_id %s", digest, file_id)
+                    text_length = None
+                else:
+                    #PDF parsing is CPU-bound; run it off the event loop so other requests progress
+                    text = await asyncio.to_thread(extract_text_from_pdf, tmp_path)
+                    if not text:
+                        raise HTTPException(status_code=400, detail="Could not extract text from PDF")
+
+                    #build the vectorstore and chain once, so /query never re-embeds;
+                    #embedding batches go out concurrently on the event loop
+                    vectorstore = await acreate_faiss_index(text)
+                    await asyncio.to_thread(persist_index, vectorstore, digest)
+                    text_length = len(text)
+
+                chain = create_pdf_chain(vectorstore)
+
+                #cache by file_id (text is dropped once the vectorstore is built)
+                evicted = await vectorstore_cache.put(file_id, {
+                    'vectorstore': vectorstore,
+                    'chain': chain,
+                    'file_name': file.filename,
+                    'digest': digest,
+                    'text_length': text_length
+                })
+                _drop_index_locks(evicted)
+
+                #publish to Redis so sibling workers skip the rebuild
+                await redis_cache.store_index(file_id, vectorstore, {
+                    'file_name': file.filename,
+                    'digest': digest,
+                    'text_length': text_length
+                })
+
+                logger.info("Indexed %s (file_id: %s, digest: %s)", file.filename, file_id, digest)
+
+                return {
+                    "file_id": file_id,
+                    "file_name": file.filename,
+                    "text_length": text_length,
+                    "already_indexed": False
+                }
+
+            finally:
+                if tmp_path and os.path.exists(tmp_path):
+                    #unlink off the event loop so metadata writes don't delay the response
+                    asyncio.create_task(asyncio.to_thread(os.unlink, tmp_path))
+
     except Exception as e:
-        logger.error(f"Error indexing PDF: {e}", exc_info=True)
+        logger.error("Error indexing PDF: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -124,34 +333,61 @@ async def query(
     file_id: str = Form(...),
     query: str = Form(...),
     chat_history: str = Form("[]"),
+    stream: bool = Form(False),
     _: bool = Depends(verify_api_key)
 ):
     try:
-        if file_id not in vectorstore_cache:
-            raise HTTPException(
-                status_code=404,
-                detail="File not indexed. Call /index_pdf first."
-            )
-        
+        cached = await vectorstore_cache.get(file_id)
+        if cached is None:
+            #fall back to the process-shared Redis cache before giving up
+            loaded = await redis_cache.load_index(file_id)
+            if loaded is None:
+                raise HTTPException(
+                    status_code=404,
+                    detail="File not indexed. Call /index_pdf first."
+                )
+            vectorstore, meta = loaded
+            cached = {
+                'vectorstore': vectorstore,
+                'chain': create_pdf_chain(vectorstore),
+                'file_name': meta.get('file_name'),
+                'digest': meta.get('digest'),
+                'text_length': meta.get('text_length')
+            }
+            _drop_index_locks(await vectorstore_cache.put(file_id, cached))
+
         try:
-            history_data = json.loads(chat_history)
+            history_data = orjson.loads(chat_history)
             messages = [Message(**msg) for msg in history_data]
-        except (json.JSONDecodeError, ValueError) as e:
+        except (orjson.JSONDecodeError, ValueError, TypeError) as e:
             raise HTTPException(status_code=400, detail=f"Invalid chat_history: {e}")
 
-        cached = vectorstore_cache[file_id]
-        chain = create_pdf_chain(cached['text'])
+        chain = cached['chain']
+
+        #history goes in as chat messages, capped to a token budget so long
+        #chats don't grow the prompt unboundedly; the retriever sees only the question
+        inputs = {
+            "input": query,
+            "chat_history": history_to_messages(truncate_history(messages))
+        }
+
+        if stream:
+            #SSE: emit answer deltas as they arrive so perceived latency
+            #is time-to-first-token instead of full-response time
+            async def event_gen():
+                async for chunk in chain.astream(inputs):
+                    delta = chunk.get("answer")
+                    if delta:
+                        yield b"data: " + orjson.dumps({"delta": delta}) + b"\n\n"
+                yield b"data: [DONE]\n\n"
 
-        if messages:
-            history_text = format_history_for_context(messages)
-            full_query = f"Previous conversation:\n{history_text}\n\nCurrent question: {query}"
-        else:
-            full_query = query
+            logger.info("Streaming query for file_id: %s", file_id)
+            return StreamingResponse(event_gen(), media_type="text/event-stream")
 
-        result = await chain.ainvoke({"input": full_query})
+        result = await chain.ainvoke(inputs)
         response = result.get("answer", "No answer found.")
         
-        logger.info(f"Query processed for file_id: {file_id}")
+        logger.info("Query processed for file_id: %s", file_id)
         
         return {
             "response": response
@@ -160,7 +396,7 @@ async def query(
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error in query: {e}", exc_info=True)
+        logger.error("Error in query: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
@@ -170,10 +406,12 @@ async def delete_from_cache(
     _: bool = Depends(verify_api_key)
 ):
 
-    if file_id in vectorstore_cache:
-        file_name = vectorstore_cache[file_id]["file_name"]
-        del vectorstore_cache[file_id]
-        logger.info(f"Removed file_id {file_id} ({file_name}) from cache")
+    entry = await vectorstore_cache.delete(file_id)
+    redis_removed = await redis_cache.delete_index(file_id)
+    if entry is not None or redis_removed:
+        _drop_index_locks([file_id])
+        file_name = entry["file_name"] if entry is not None else file_id
+        logger.info("Removed file_id %s (%s) from cache", file_id, file_name)
         return {"message": f"Removed {file_name} from cache"}
     else:
         raise HTTPException(status_code=404, detail="File not found in cache")
@@ -190,24 +428,28 @@ async def health_check():
 
 @app.get("/cache_stats")
 async def cache_stats(_: bool = Depends(verify_api_key)):
+    entries = await vectorstore_cache.snapshot()
     return {
-        "indexed_files": len(vectorstore_cache),
+        "indexed_files": len(entries),
+        "total_bytes": vectorstore_cache.total_bytes,
+        "max_bytes": vectorstore_cache.max_bytes,
         "files": [
             {
                 "file_id": file_id,
                 "name": info["file_name"],
-                "text_length": info["text_length"]
+                "text_length": info["text_length"],
+                "nbytes": info["nbytes"]
             }
-            for file_id, info in vectorstore_cache.items()
+            for file_id, info in entries
         ]
     }
 
 
 @app.post("/clear_cache")
 async def clear_cache(_: bool = Depends(verify_api_key)):
-    count = len(vectorstore_cache)
-    vectorstore_cache.clear()
-    logger.info(f"Cleared {count} files from cache")
+    count = await vectorstore_cache.clear()
+    _index_locks.clear()
+    logger.info("Cleared %s files from cache", count)
     return {"message": f"Cleared {count} files from cache"}
 
 
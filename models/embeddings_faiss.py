@@ -1,25 +1,264 @@
+import asyncio
+import hashlib
+import math
+import os
+import pickle
+import uuid
+from collections import OrderedDict
+from typing import Any
+
+import faiss
+import numpy as np
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_core.documents import Document 
 from config.settings import OPENAI_API_KEY
+from config.http_client import ASYNC_CLIENT, SYNC_CLIENT
 
-embeddings = OpenAIEmbeddings(api_key=OPENAI_API_KEY)
+#LRU over query embeddings: conversational users repeat or lightly rephrase
+#questions, and each hit skips an OpenAI round trip (~6KB per cached vector)
+QUERY_CACHE_SIZE = 4096
 
-def create_faiss_index(text: str):
+_query_cache = OrderedDict()
+
+def _query_cache_get(key):
+    vector = _query_cache.get(key)
+    if vector is not None:
+        _query_cache.move_to_end(key)
+    return vector
+
+def _query_cache_put(key, vector):
+    _query_cache[key] = vector
+    if len(_query_cache) > QUERY_CACHE_SIZE:
+        _query_cache.popitem(last=False)
+
+class CachedOpenAIEmbeddings(OpenAIEmbeddings):
+    """OpenAIEmbeddings with an LRU over embed_query keyed by normalized text."""
+
+    def embed_query(self, text: str):
+        key = text.strip().lower()
+        vector = _query_cache_get(key)
+        if vector is None:
+            vector = super().embed_query(text)
+            _query_cache_put(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str):
+        key = text.strip().lower()
+        vector = _query_cache_get(key)
+        if vector is None:
+            vector = await super().aembed_query(text)
+            _query_cache_put(key, vector)
+        return vector
+
+embeddings = CachedOpenAIEmbeddings(
+    api_key=OPENAI_API_KEY,
+    chunk_size=512,
+    max_retries=6,
+    show_progress_bar=False,
+    http_client=SYNC_CLIENT,
+    http_async_client=ASYNC_CLIENT
+)
+
+#embed at most this many chunks per API call to stay under the token/min rate cap
+EMBED_BATCH_SIZE = 200
+
+#above this many chunks, a compressed IVFPQ index beats brute-force flat search
+IVFPQ_CHUNK_THRESHOLD = 2000
+
+#directory where built indexes are persisted, keyed by sha256 of the PDF bytes
+INDEX_DIR = os.getenv("INDEX_DIR", "./indexes")
+
+#cap concurrent embedding requests to stay under OpenAI rate limits
+EMBED_CONCURRENCY = 8
+
+#token-aware splitter, built once: sizing chunks in tokens (not characters)
+#keeps embedding inputs uniformly dense and yields noticeably fewer chunks
+_SPLITTER = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+    model_name="text-embedding-3-small",
+    chunk_size=512,
+    chunk_overlap=64,
+)
+
+def split_text(text: str):
     if not text:
         raise ValueError("Cannot create index from empty text.")
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = splitter.split_text(text)
-    
+    chunks = _SPLITTER.split_text(text)
+
     if not chunks:
         raise ValueError("Text was too short to be split into chunks.")
 
-    docs = [Document(page_content=chunk) for chunk in chunks]
+    return chunks
+
+def dedupe_chunks(chunks):
+    """Collapse exact-duplicate chunks (repeated headers/footers, TOC lines).
+
+    Returns the unique chunks keyed by content hash plus the per-chunk key
+    order, so vectors can be fanned back out after a single embedding pass.
+    """
+    unique = {}
+    order = []
+    for chunk in chunks:
+        key = hashlib.blake2b(chunk.encode(), digest_size=16).digest()
+        if key not in unique:
+            unique[key] = chunk
+        order.append(key)
+    return unique, order
+
+def embed_chunks(chunks):
+    """Embed chunks in large batches instead of one request per chunk."""
+    vectors = []
+    for start in range(0, len(chunks), EMBED_BATCH_SIZE):
+        batch = chunks[start:start + EMBED_BATCH_SIZE]
+        vectors.extend(embeddings.embed_documents(batch))
+    return vectors
+
+async def aembed_chunks(chunks):
+    """Embed all batches concurrently on the event loop (bounded by a semaphore)."""
+    semaphore = asyncio.Semaphore(EMBED_CONCURRENCY)
+
+    async def embed_batch(batch):
+        async with semaphore:
+            return await embeddings.aembed_documents(batch)
+
+    batches = [chunks[start:start + EMBED_BATCH_SIZE]
+               for start in range(0, len(chunks), EMBED_BATCH_SIZE)]
+    results = await asyncio.gather(*[embed_batch(batch) for batch in batches])
+
+    vectors = []
+    for result in results:
+        vectors.extend(result)
+    return vectors
+
+def create_faiss_index(text: str):
+    chunks = split_text(text)
+    unique, order = dedupe_chunks(chunks)
+    unique_vectors = embed_chunks(list(unique.values()))
+    vector_by_key = dict(zip(unique.keys(), unique_vectors))
+    vectors = [vector_by_key[key] for key in order]
+    return build_vectorstore(chunks, vectors)
+
+async def acreate_faiss_index(text: str):
+    chunks = split_text(text)
+    unique, order = dedupe_chunks(chunks)
+    unique_vectors = await aembed_chunks(list(unique.values()))
+    vector_by_key = dict(zip(unique.keys(), unique_vectors))
+    vectors = [vector_by_key[key] for key in order]
+    return build_vectorstore(chunks, vectors)
+
+def build_vectorstore(chunks, vectors):
+    """Wrap embedded chunks in a FAISS vectorstore.
+
+    Small PDFs get an exact flat index; above IVFPQ_CHUNK_THRESHOLD chunks
+    we switch to IVFPQ, which is 16-32x smaller in memory and much faster
+    to search, with negligible recall loss at k=3.
+    """
+    if len(chunks) <= IVFPQ_CHUNK_THRESHOLD:
+        return FAISS.from_embeddings(list(zip(chunks, vectors)), embeddings)
+
+    matrix = np.asarray(vectors, dtype=np.float32)
+    n, dim = matrix.shape
+    nlist = int(4 * math.sqrt(n))
+    index = faiss.index_factory(dim, f"IVF{nlist},PQ16x8")
+    index.train(matrix)
+    index.add(matrix)
+    index.nprobe = max(8, nlist // 16)
+
+    docstore = InMemoryDocstore()
+    index_to_docstore_id = {}
+    for i, chunk in enumerate(chunks):
+        doc_id = str(uuid.uuid4())
+        docstore.add({doc_id: Document(page_content=chunk)})
+        index_to_docstore_id[i] = doc_id
+
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+    )
+
+def load_persisted_index(digest: str):
+    """Reload a previously persisted index for this PDF digest, if any.
+
+    The raw FAISS file is opened with mmap so vectors stay on disk and the
+    OS page cache keeps only the hot pages resident, instead of pulling
+    every cached PDF's vectors into RAM on load.
+    """
+    path = os.path.join(INDEX_DIR, digest)
+    if not os.path.isdir(path):
+        return None
+
+    #save_local writes index.faiss plus the pickled docstore/id mapping
+    with open(os.path.join(path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+
+    try:
+        index = faiss.read_index(
+            os.path.join(path, "index.faiss"),
+            faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+        )
+    except RuntimeError:
+        #not every index type supports mmapped reads; fall back to a resident load
+        index = faiss.read_index(os.path.join(path, "index.faiss"))
+
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+    )
+
+def persist_index(vectorstore, digest: str):
+    """Save a built index to disk so restarts and re-uploads skip re-embedding."""
+    os.makedirs(INDEX_DIR, exist_ok=True)
+    vectorstore.save_local(os.path.join(INDEX_DIR, digest))
+
+class FaissTopKRetriever(BaseRetriever):
+    """Retriever that searches the FAISS index directly and picks top-k in NumPy.
+
+    Fetches fetch_k candidates, then selects the k best with np.argpartition
+    (O(n) and SIMD-vectorized) instead of sorting the full candidate list in
+    Python.
+    """
+
+    vectorstore: Any
+    k: int = 3
+    fetch_k: int = 20
+
+    def _top_k_docs(self, distances, indices):
+        d = distances[0]
+        ids = indices[0]
+        valid = ids != -1
+        d = d[valid]
+        ids = ids[valid]
+        if len(d) > self.k:
+            #L2 distances: smaller is better
+            part = np.argpartition(d, self.k)[:self.k]
+            order = part[np.argsort(d[part])]
+        else:
+            order = np.argsort(d)
+        docs = []
+        for pos in order:
+            doc_id = self.vectorstore.index_to_docstore_id[int(ids[pos])]
+            docs.append(self.vectorstore.docstore.search(doc_id))
+        return docs
+
+    def _get_relevant_documents(self, query: str, *, run_manager):
+        vector = np.asarray([embeddings.embed_query(query)], dtype=np.float32)
+        distances, indices = self.vectorstore.index.search(vector, self.fetch_k)
+        return self._top_k_docs(distances, indices)
 
-    vectorstore = FAISS.from_documents(docs, embeddings)
-    return vectorstore
+    async def _aget_relevant_documents(self, query: str, *, run_manager):
+        vector = np.asarray([await embeddings.aembed_query(query)], dtype=np.float32)
+        distances, indices = await asyncio.to_thread(
+            self.vectorstore.index.search, vector, self.fetch_k
+        )
+        return self._top_k_docs(distances, indices)
 
 def get_retriever(vectorstore):
-    return vectorstore.as_retriever(search_kwargs={"k": 3})
+    return FaissTopKRetriever(vectorstore=vectorstore)
@@ -1,10 +1,9 @@
-from PyPDF2 import PdfReader
+import fitz
 
 def extract_text_from_pdf(file_path: str) -> str:
-    text = ""
-    reader = PdfReader(file_path)
-    for page in reader.pages:
-        content = page.extract_text()
-        if content:
-            text += content + "\n"
-    return text.strip()
+    doc = fitz.open(file_path)
+    try:
+        parts = [page.get_text("text") for page in doc]
+    finally:
+        doc.close()
+    return "\n".join(parts).strip()
@@ -0,0 +1,56 @@
+import os
+
+import orjson
+from redis import asyncio as aioredis
+from langchain_community.vectorstores import FAISS
+
+from models.embeddings_faiss import embeddings
+
+#when REDIS_URL is set, indexes are shared across uvicorn workers via Redis;
+#without it the service falls back to the per-process cache only
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_TTL_SECONDS = int(os.getenv("REDIS_TTL_SECONDS", str(24 * 3600)))
+
+_client = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+
+def redis_enabled() -> bool:
+    return _client is not None
+
+def _faiss_key(file_id: str) -> str:
+    return f"pdf:{file_id}:faiss"
+
+def _meta_key(file_id: str) -> str:
+    return f"pdf:{file_id}:meta"
+
+async def store_index(file_id: str, vectorstore, meta: dict):
+    """Serialize the vectorstore and its metadata into Redis with a TTL."""
+    if _client is None:
+        return
+    data = vectorstore.serialize_to_bytes()
+    async with _client.pipeline(transaction=False) as pipe:
+        pipe.set(_faiss_key(file_id), data, ex=REDIS_TTL_SECONDS)
+        pipe.set(_meta_key(file_id), orjson.dumps(meta), ex=REDIS_TTL_SECONDS)
+        await pipe.execute()
+
+async def load_index(file_id: str):
+    """Deserialize a vectorstore built by another worker, or None on miss."""
+    if _client is None:
+        return None
+    data = await _client.get(_faiss_key(file_id))
+    if data is None:
+        return None
+    raw_meta = await _client.get(_meta_key(file_id))
+    meta = orjson.loads(raw_meta) if raw_meta else {}
+    vectorstore = FAISS.deserialize_from_bytes(
+        data, embeddings, allow_dangerous_deserialization=True
+    )
+    return vectorstore, meta
+
+async def delete_index(file_id: str) -> int:
+    if _client is None:
+        return 0
+    return await _client.delete(_faiss_key(file_id), _meta_key(file_id))
+
+async def close_redis():
+    if _client is not None:
+        await _client.aclose()